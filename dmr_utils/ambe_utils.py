@@ -25,6 +25,7 @@
 ###############################################################################
 
 from binascii import b2a_hex as ahex
+from binascii import a2b_hex as bhex
 from bitarray import bitarray
 from bitstring import BitArray
 from bitstring import BitString
@@ -258,3 +259,12 @@ def convert49BitTo72BitAMBE( ambe49 ):
     ambe_fr = demodulateAmbe3600x2450(ambe_fr)         # demodulate C1
     ambe72 = interleave(ambe_fr);                      # Re-interleave it, returning 72 bits
     return ambe72
+
+# Extract the three 49 bit AMBE frames from the 19 byte IPSC voice payload (bits 0-48, 50-98 and 100-148);
+# each frame is left aligned and zero padded into 7 bytes, returning the 21 byte concatenation.
+def extract49BitAmbeFrames( payload ):
+    frames = int(ahex(payload[0:19]), 16)               # 152 bits, MSB first
+    ambe49_1 = (frames >> 103) & 0x1FFFFFFFFFFFF
+    ambe49_2 = (frames >> 53) & 0x1FFFFFFFFFFFF
+    ambe49_3 = (frames >> 3) & 0x1FFFFFFFFFFFF
+    return bhex('%042x' % ((ambe49_1 << 119) | (ambe49_2 << 63) | (ambe49_3 << 7)))
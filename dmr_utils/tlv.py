@@ -33,22 +33,23 @@ from bitarray import bitarray
 from bitstring import BitArray
 from bitstring import BitString
 import struct
-from time import time, sleep
+from time import time
 from importlib import import_module
 from binascii import b2a_hex as ahex
 from random import randint
 import sys, socket, configparser, traceback
 from threading import Lock
-from time import time, sleep, clock, localtime, strftime
+from time import time, clock, localtime, strftime
 from pprint import pprint
 
 # Twisted is pretty important, so I keep it separate
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 from twisted.internet import task
+from twisted.python.failure import Failure
 
 # Things we import from the core modules
-from fne.fne_core import int_to_bytes, bytes_to_int, short_to_bytes
+from fne.fne_core import bytes_to_int, short_to_bytes
 
 from dmr_utils import lc, bptc, const, golay, qr, rs129
 
@@ -71,6 +72,8 @@ TAG_AMBE_72     = 0x0B      # AMBE frame of 72 bit samples (FNE)
 
 TAG_DMR_TEST    = 0xFF
 
+FRAME_TIME      = 0.06      # Seconds between DMR voice frames (header and silence frames are paced at this rate)
+
 # ---------------------------------------------------------------------------
 #   Globals
 # ---------------------------------------------------------------------------
@@ -122,6 +125,9 @@ class RX_SLOT(SLOT):
         self.vf = 0                                         # Voice Frame (A-F in DMR spec)
         self.seq = 0                                        # Incrementing sequence number for each DMR frame
         self.emblc = [None] * 6                             # Storage for embedded LC
+        self.header_loop = None                             # LoopingCall pacing out the current voice header
+        self.header_done = None                             # Deferred that fires once the voice header has been paced out
+        self.silence_loop = None                            # LoopingCall sending DMR_TEST silence, while one is running
 
 # ---------------------------------------------------------------------------
 #   Class Declaration
@@ -146,10 +152,11 @@ class tlvBase:
         self._config = _config
         self._system = _name
         
-        self._gateways = [(self._parent._gateway, self._parent._gateway_port)]
+        self._gateway = (self._parent._gateway, self._parent._gateway_port)
         self._tlvPort = _port                               # Port to listen on for TLV frames to transmit to all peers
 
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.connect(self._gateway)                   # There is one partner, so fix the destination once and use send()
 
         self._slot = 2                                      # "current slot"
         self.rx = [0, RX_SLOT(1, 0, 0, 0, 1), RX_SLOT(2, 0, 0, 0, 1)]
@@ -169,6 +176,46 @@ class tlvBase:
         _rx_slot.seq = 0                                    # Starts at zero for each incoming transmission, wraps back to zero when 256 is reached.
         _rx_slot.frame_count = 0                            # Number of voice frames in this session (will be greater than zero of header is sent)
 
+    # Call _send_frame _count times, one frame time apart, from the reactor rather than sleeping between
+    # frames; frames for the slot that arrive meanwhile are held by after_header() until it is done
+    def pace_header(self, _rx_slot, _send_frame, _count):
+        _remaining = [_count]
+        def send_next():
+            if _remaining[0] <= 0:
+                _header_loop.stop()
+                return
+            _send_frame()
+            _remaining[0] -= 1
+
+        def header_sent(_result):
+            if _rx_slot.header_done is _header_done:
+                _rx_slot.header_done = None
+            if isinstance(_result, Failure):
+                self._logger.error('(%s) Voice header on TS %d failed: %s', self._system, _rx_slot.slot, _result.getErrorMessage())
+
+        # a new header replaces one still going out on the slot; frames held for the old one are dropped
+        _previous_loop = _rx_slot.header_loop
+        _header_loop = task.LoopingCall(send_next)
+        _rx_slot.header_loop = _header_loop
+        if _previous_loop is not None and _previous_loop.running:
+            _previous_loop.stop()
+
+        _header_done = _header_loop.start(FRAME_TIME, now=True)
+        _rx_slot.header_done = _header_done
+        _header_done.addBoth(header_sent)
+
+    # Run _func now, or once the voice header for the slot has gone out, so frames keep their order
+    def after_header(self, _rx_slot, _func, *args):
+        if _rx_slot.header_done is None:
+            _func(*args)
+            return
+
+        _header_loop = _rx_slot.header_loop
+        def run(_result):
+            if _rx_slot.header_loop is _header_loop:
+                _func(*args)
+        _rx_slot.header_done.addCallback(run)
+
     def send_pi_header(self, _rx_slot):
         pass
 
@@ -233,60 +280,78 @@ class tlvBase:
                             _rx_slot.mi = v[5:9]
                         self._logger.info('(%s) TLV PI_INFO, STREAM ID %s SRC_ID %s PEER %s TS %s ALG %s KID %s', \
                                         self._system, _rx_slot.stream_id, _rx_slot.src_id, _rx_slot.peer_id, _slot, _rx_slot.alg_id, _rx_slot.key_id)
-                        self.send_pi_header(_rx_slot)
+                        self.after_header(_rx_slot, self.send_pi_header, _rx_slot)
                     elif (t == TAG_END_TX):
                         _slot = v[0]
                         _rx_slot = self.rx[_slot]
-                        if _rx_slot.frame_count > 0:
-                            self.send_voice_term(_rx_slot)
-                        
-                        self._logger.info('(%s) TLV END_TX, STREAM ID %d FRAMES %d', self._system, _rx_slot.stream_id, _rx_slot.frame_count)
-                        
-                        # set it back to zero so any random AMBE frames are ignored.
-                        _rx_slot.frame_count = 0
+                        self.after_header(_rx_slot, self.end_tx, _rx_slot)
 
                     elif (t == TAG_AMBE_72): # generic AMBE or specific AMBE72
                         _slot = v[0]
                         _rx_slot = self.rx[_slot]
                         if _rx_slot.frame_count > 0:
-                            self.send_voice72(_rx_slot, v[1:])
+                            self.after_header(_rx_slot, self.send_voice72, _rx_slot, v[1:])
                     elif (t == TAG_AMBE_49): # AMBE49
                         _slot = v[0]
                         _rx_slot = self.rx[_slot]
                         if _rx_slot.frame_count > 0:
-                            self.send_voice49(_rx_slot, v[1:])
+                            self.after_header(_rx_slot, self.send_voice49, _rx_slot, v[1:])
 
                     elif (t == TAG_DMR_TEST):
-                        _rx_slot.dst_id = int(v.split('=')[1])
-                        self._logger.info('(%s) TLV DMR_TEST, TGID %d TS %d', self._system, _rx_slot.dst_id, _rx_slot.slot)
-                        #TODO: fix this thread
-                        thread.start_new_thread(self.sendBlankAmbe, (_rx_slot, randint(0,0xFFFFFFFF), 5 * 60 * 500))
+                        if _rx_slot.silence_loop is not None and _rx_slot.silence_loop.running:
+                            self._logger.warning('(%s) TLV DMR_TEST ignored, TS %d is already sending silence', self._system, _rx_slot.slot)
+                        else:
+                            _rx_slot.dst_id = int(v.split('=')[1])
+                            self._logger.info('(%s) TLV DMR_TEST, TGID %d TS %d', self._system, _rx_slot.dst_id, _rx_slot.slot)
+                            self.sendBlankAmbe(_rx_slot, randint(0,0xFFFFFFFF), 5 * 60 * 500)
                             
                     else:
                         self._logger.info('(%s) TLV unknown, T %d L %d, V %s', self._system, t, ord(l), ahex(v))
             else:
                 self._logger.info('(%s) EOF on UDP stream', self._system)
 
+    # Close out the transmission on the slot once the partner ends it
+    def end_tx(self, _rx_slot):
+        if _rx_slot.frame_count > 0:
+            self.send_voice_term(_rx_slot)
+
+        self._logger.info('(%s) TLV END_TX, STREAM ID %d FRAMES %d', self._system, _rx_slot.stream_id, _rx_slot.frame_count)
+
+        # set it back to zero so any random AMBE frames are ignored.
+        _rx_slot.frame_count = 0
+
     def stop_listening(self):
         self.udp_port.stopListening()
 
     def send_tlv(self, _tag, _value):
         _tlv = struct.pack("bb", _tag, len(_value)) + _value
-        for _gateway in self._gateways:
-            self._sock.sendto(_tlv, _gateway)
+        try:
+            self._sock.send(_tlv)
+        except socket.error as e:
+            # a connected UDP socket reports ICMP errors (i.e. the partner isn't running yet) on the next send
+            self._logger.debug('(%s) TLV send to %s:%s failed: %s', self._system, self._gateway[0], self._gateway[1], e)
 
     # TG selection, send a simple blank voice frame to network
     def sendBlankAmbe(self, _rx_slot, _stream_id, _frames=1):
         _rx_slot.stream_id = _stream_id
         self.send_voice_header(_rx_slot)
-        sleep(0.06)
         silence = b'\xAC\AA\x40\x20\x00\x44\x40\x80\x80'
         self._logger.info('(%s) Silence %d frames', self._system, _frames)
-        while _frames > 0:
+
+        # pace the frames from the reactor (one every 60ms) rather than sleeping in a thread; the loop is kept
+        # on the slot so a second DMR_TEST can't start another one alongside it
+        _remaining = [_frames]
+        def send_silence():
+            if _remaining[0] <= 0:
+                _rx_slot.silence_loop.stop()
+                _rx_slot.silence_loop = None
+                self.send_voice_term(_rx_slot)
+                return
             self.send_voice72(_rx_slot, silence + silence + silence)
-            sleep(0.06)
-            _frames = _frames - 1
-        self.send_voice_term(_rx_slot)
+            _remaining[0] -= 1
+
+        _rx_slot.silence_loop = task.LoopingCall(send_silence)
+        self.after_header(_rx_slot, _rx_slot.silence_loop.start, FRAME_TIME, True)
 
     # Begin export call to partner                
     def begin_call(self, _slot, _group_call, _src_id, _dst_id, _peer_id, _cc, _seq, _stream_id):
@@ -316,9 +381,7 @@ class tlvBase:
 
     # Send PI call parameters to partner                
     def pi_params(self, _slot, _dst_id, _alg_id, _key_id, _mi):
-        metadata = _dst_id[0:3] + int_to_bytes(_alg_id) + int_to_bytes(_key_id) + _mi[0:4] + struct.pack('B', _slot)
-
-        sleep(0.06)
+        metadata = _dst_id[0:3] + struct.pack('B', _alg_id) + struct.pack('B', _key_id) + _mi[0:4] + struct.pack('B', _slot)
 
         # start transmission
         self.send_tlv(TAG_PI_INFO, metadata)    
@@ -365,9 +428,7 @@ class tlvFNE(tlvBase):
         tlvBase.send_voice_header(self, _rx_slot)
         flag = lc_header_flag(_rx_slot.slot)
         dmr = self.encode_voice_header(_rx_slot)
-        for j in range(0,2):
-            self.send_fne_frame(_rx_slot, flag, dmr)
-            sleep(0.06)
+        self.pace_header(_rx_slot, lambda: self.send_fne_frame(_rx_slot, flag, dmr), 2)
 
     def send_pi_header(self, _rx_slot):
         flag = pi_header_flag(_rx_slot.slot)
@@ -552,7 +613,7 @@ class tlvIPSC(tlvBase):
         self.ipsc_seq = (self.ipsc_seq + 1) & 0xff          # this is an 8 bit value which wraps around.
         self.emb_lc = ''
 
-        for i in range(0, 3):                               # Output the 3 HEAD frames to our peers
+        def send_head():
             voiceHeader = self.generate_voice_header(_rx_slot, BURST_DATA_TYPE['VOICE_HEADER'])
             rtpHeader = self.generate_rtp_header(_rx_slot, RTP_PAYLOAD_VOICE_HEADER, 0)
             ipscHeader = self.generate_ipsc_voice_header(_rx_slot)
@@ -560,7 +621,8 @@ class tlvIPSC(tlvBase):
             frame = ipscHeader + rtpHeader + voiceHeader
 
             self.send_ipsc(_rx_slot.slot, frame)
-            sleep(0.06)
+
+        self.pace_header(_rx_slot, send_head, 3)             # Output the 3 HEAD frames to our peers
         pass
     
     def send_pi_header(self, _rx_slot):
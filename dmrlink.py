@@ -27,6 +27,7 @@
 from __future__ import print_function
 
 import logging
+import struct
 import cPickle as pickle
 
 from hmac import new as hmac_new
@@ -47,8 +48,21 @@ from twisted.internet import reactor, task
 
 from ipsc.ipsc_const import *
 from ipsc.ipsc_mask import *
+from ipsc.ipsc_udp import set_socket_buffers
 
-from fne.fne_core import int_to_bytes, bytes_to_int, short_to_bytes
+from fne.fne_core import int_to_bytes, short_to_bytes
+
+# ---------------------------------------------------------------------------
+#   Constants
+# ---------------------------------------------------------------------------
+
+# Fixed layouts of the IPSC packet header, unpacked with one call instead of a slice per field
+IPSC_HEADER      = struct.Struct('>c4s')                    # Packet Type, Peer ID (kept as bytes, like the opcode constants and peer list keys)
+IPSC_USER_HEADER = struct.Struct('>3s3s5xB')                # Source ID, Destination ID (3 byte strings), [Call Priority, Call Tag], Control (from byte 6)
+IPSC_RTP_HEADER  = struct.Struct('>xBHII')                  # [Call Ctrl Src], Payload Type, Seq No, Timestamp, Sync Src Id (from byte 18)
+IPSC_USER_MIN_LEN = 18 + IPSC_RTP_HEADER.size + 1           # Shortest user packet: all of the headers above plus the burst type byte
+
+REPORT_BATCH_DELAY = 0.005                                  # Longest a report message waits to be batched (seconds)
 
 # Global variables used whether we are a module or __main__
 systems = {}
@@ -136,7 +150,8 @@ def mk_ipsc_systems(_config, _logger, _systems, _ipsc, _report_server):
     for system in _config['Systems']:
         if _config['Systems'][system]['LOCAL']['Enabled']:
             _systems[system] = _ipsc(system, _config, _logger, _report_server)
-            reactor.listenUDP(_config['Systems'][system]['LOCAL']['PORT'], _systems[system], interface=_config['Systems'][system]['LOCAL']['IP'])
+            _port = reactor.listenUDP(_config['Systems'][system]['LOCAL']['PORT'], _systems[system], interface=_config['Systems'][system]['LOCAL']['IP'])
+            set_socket_buffers(_port)
     return _systems
 
 # Process the MODE byte in registration/peer list packets for determining master and peer capabilities
@@ -258,6 +273,18 @@ def log_master(_system, _logger, _config):
 
         _logger.info('(%s) PEER ID: %s, Modes: %s, Service Flags: %s, Status: %s, KeepAlives [Sent: %s, Outstanding: %s, Missed: %s, Received: %s]', _system, int(ahex(_master['PEER_ID']), 16), modeValue, flagValue, _master['STATUS']['CONNECTED'], _master['STATUS']['KEEP_ALIVES_SENT'], _master['STATUS']['KEEP_ALIVES_OUTSTANDING'], _master['STATUS']['KEEP_ALIVES_MISSED'], _master['STATUS']['KEEP_ALIVES_RECEIVED'])
 
+# ---------------------------------------------------------------------------
+#   Class Declaration
+#     Hex encodes a packet only when the log record holding it is formatted.
+# ---------------------------------------------------------------------------
+
+class lazyHex:
+    def __init__(self, _data):
+        self._data = _data
+
+    def __str__(self):
+        return ahex(self._data)
+
 # ---------------------------------------------------------------------------
 #   Class Declaration
 #
@@ -266,11 +293,7 @@ def log_master(_system, _logger, _config):
 class RTP:
     def __init__(self, _data):
         # parse out the RTP values
-        #self._rtp_byte_1 = bytes_to_int(_data[18:19])     # Call Ctrl Src
-        self.rtp_payload_type = bytes_to_int(_data[19:20])# Type
-        self.seq = bytes_to_int(_data[20:22])             # Seq No
-        self.timestamp = bytes_to_int(_data[22:26])       # Timestamp
-        self.ssrc = bytes_to_int(_data[26:30])            # Sync Src Id
+        self.rtp_payload_type, self.seq, self.timestamp, self.ssrc = IPSC_RTP_HEADER.unpack_from(_data, 18)
 
         # Extract RTP Payload Data Fields
         self.ipsc_payload_type = _data[30]                # int8  VOICE_HEAD, VOICE_TERM, SLOT1_VOICE, SLOT2_VOICE
@@ -297,6 +320,11 @@ class IPSC(DatagramProtocol):
         self._local = self._config['LOCAL']
         self._local_id = self._local['PEER_ID']
 
+        # Fixed once configured, but needed for every packet sent or received; keep them one attribute away
+        self._auth_enabled = self._local['AuthEnabled']
+        self._auth_key = self._local['AuthKey']
+        self._raw_packet_trace = self._CONFIG['Log']['RawPacketTrace'] and self._logger.isEnabledFor(logging.DEBUG)
+
         #
         self._master = self._config['MASTER']
         self._master_stat = self._master['STATUS']
@@ -486,14 +514,14 @@ class IPSC(DatagramProtocol):
     # ************************************************    
     # Simple function to send packets - handy to have it all in one place for debugging
     def send_packet(self, _packet, _host, _port):
-        if self._local['AuthEnabled']:
-            _hash = bhex((hmac_new(self._local['AuthKey'], _packet, sha1)).hexdigest()[:20])
+        if self._auth_enabled:
+            _hash = bhex((hmac_new(self._auth_key, _packet, sha1)).hexdigest()[:20])
             _packet = _packet + _hash
 
         self.transport.write(_packet, (_host, _port))
 
-        if self._CONFIG['Log']['RawPacketTrace']:
-            self._logger.debug('(%s) Network Transmitted (to %s:%s) -- %s', self._system, _host, _port, ahex(_packet))
+        if self._raw_packet_trace:
+            self._logger.debug('(%s) Network Transmitted (to %s:%s) -- %s', self._system, _host, _port, lazyHex(_packet))
         
     # Accept a complete packet, ready to be sent, and send it to all active peers + master in an IPSC
     def send_to_ipsc(self, _packet):
@@ -794,16 +822,18 @@ class IPSC(DatagramProtocol):
     # Callbacks are iterated in the order of "more likely" to "less likely" to reduce processing time
     def datagramReceived(self, _data, hostInfo):
         _host, _port = hostInfo
-        if self._CONFIG['Log']['RawPacketTrace']:
-            self._logger.debug('(%s) Network Received (from %s:%s) -- %s', self._system, _host, _port, ahex(_data))
+        if self._raw_packet_trace:
+            self._logger.debug('(%s) Network Received (from %s:%s) -- %s', self._system, _host, _port, lazyHex(_data))
+
+        if len(_data) < IPSC_HEADER.size:
+            self._logger.warning('(%s) Dropping short IPSC packet (%d bytes) from %s:%s', self._system, len(_data), _host, _port)
+            return
 
-        _packetType = bytes_to_int(_data[0:1])
-        _peerId     = bytes_to_int(_data[1:5])
-        _ipsc_seq   = bytes_to_int(_data[5:6])
+        _packetType, _peerId = IPSC_HEADER.unpack_from(_data, 0)
     
         # AUTHENTICATE THE PACKET
-        if self._local['AuthEnabled']:
-            if not self.validate_auth(self._local['AuthKey'], _data):
+        if self._auth_enabled:
+            if not self.validate_auth(self._auth_key, _data):
                 self._logger.warning('(%s) AuthError: IPSC packet failed authentication. Type %s: Peer: %s, %s:%s', self._system, ahex(_packetType), _peerId, _host, _port)
                 return
             
@@ -819,12 +849,12 @@ class IPSC(DatagramProtocol):
                 
             # ORIGINATED BY SUBSCRIBER UNITS - a.k.a someone transmitted
             if _packetType in USER_PACKETS:
+                if len(_data) < IPSC_USER_MIN_LEN:
+                    self._logger.warning('(%s) Dropping malformed user packet (%d bytes) from peer %s, %s:%s', self._system, len(_data), _peerId, _host, _port)
+                    return
+
                 # Extract IPSC header not already extracted
-                _src_id = bytes_to_int(_data[6:9])
-                _dst_id = bytes_to_int(_data[9:12])
-                _call_priority = bytes_to_int(_data[12:13])
-                _call_tag = bytes_to_int(_data[13:17])
-                _control = bytes_to_int(_data[17:18])
+                _src_id, _dst_id, _control = IPSC_USER_HEADER.unpack_from(_data, 6)
 
                 _rtp        = RTP(_data)
 
@@ -997,6 +1027,13 @@ class reportFactory(Factory):
     def __init__(self, config, logger):
         self._config = config
         self._logger = logger
+
+        # Messages are gathered (already netstring framed) and written to clients in one go, once
+        # ReportBatchSize bytes are waiting or REPORT_BATCH_DELAY has passed; a size of 0 disables batching
+        self._batch_size = self._config['Reports']['ReportBatchSize']
+        self._batch = []
+        self._batch_len = 0
+        self._batch_call = None
         
     def buildProtocol(self, addr):
         if (addr.host) in self._config['Reports']['ReportClient'] or '*' in self._config['Reports']['ReportClient']:
@@ -1007,8 +1044,36 @@ class reportFactory(Factory):
             return None
             
     def send_clients(self, _message):
+        if not self._batch_size:
+            for client in self.clients:
+                client.sendString(_message)
+            return
+
+        # Frame the message here, once, exactly as NetstringReceiver.sendString() does ('<len>:<message>,'),
+        # so the whole batch can go to each client as a single transport.write() in flush_clients()
+        _netstring = str(len(_message)) + ':' + _message + ','
+        self._batch.append(_netstring)
+        self._batch_len += len(_netstring)
+        if self._batch_len >= self._batch_size:
+            self.flush_clients()
+        elif self._batch_call is None:
+            self._batch_call = reactor.callLater(REPORT_BATCH_DELAY, self.flush_clients)
+
+    # Write the batched messages to every client
+    def flush_clients(self):
+        if self._batch_call is not None:
+            if self._batch_call.active():
+                self._batch_call.cancel()
+            self._batch_call = None
+
+        if not self._batch:
+            return
+        _data = ''.join(self._batch)
+        self._batch = []
+        self._batch_len = 0
+
         for client in self.clients:
-            client.sendString(_message)
+            client.transport.write(_data)
             
     def send_config(self):
         serialized = pickle.dumps(self._config['Systems'], protocol = pickle.HIGHEST_PROTOCOL)
@@ -31,15 +31,9 @@
 ###############################################################################
 from __future__ import print_function
 
-import sys, socket, ConfigParser, thread, traceback
-import cPickle as pickle
-import csv
-import struct
+import os, sys, ConfigParser
 
-from binascii import b2a_hex as ahex
-from bitstring import BitArray
-from time import time, sleep, clock, localtime, strftime
-from random import randint
+from collections import namedtuple
 
 from twisted.python import log
 from twisted.internet import reactor
@@ -52,10 +46,82 @@ from ipsc.ipsc_mask import *
 from dmr_utils import ambe_utils
 from dmr_utils.tlv import tlvIPSC
 
-from ipsc.ipsc_const import *
-from ipsc.ipsc_mask import *
-    
-from fne.fne_core import int_to_bytes, bytes_to_int, short_to_bytes
+# ---------------------------------------------------------------------------
+#   Constants
+# ---------------------------------------------------------------------------
+
+# Burst data types checked for every voice packet, bound once rather than looked up in BURST_DATA_TYPE each time;
+# kept as ints to compare directly against the burst type byte from parse_voice_header()
+_BDT_PI_HEADER          = ord(BURST_DATA_TYPE['PI_HEADER'])
+_BDT_VOICE_HEADER       = ord(BURST_DATA_TYPE['VOICE_HEADER'])
+_BDT_VOICE_TERMINATOR   = ord(BURST_DATA_TYPE['VOICE_TERMINATOR'])
+_BDT_SLOT1_VOICE        = ord(BURST_DATA_TYPE['SLOT1_VOICE'])
+_BDT_SLOT2_VOICE        = ord(BURST_DATA_TYPE['SLOT2_VOICE'])
+
+VOICE_BURST_LEN         = 52                                # Voice burst length up to the end of its 19 byte AMBE payload (bytes 33-51)
+PI_HEADER_LEN           = 45                                # PI header length up to the end of its MI (alg id 38, key id 40, MI 41-44)
+
+# Bridge settings for a single IPSC system, and the values used when the configuration file doesn't set them
+BridgeCfg = namedtuple('BridgeCfg', 'gateway gateway_port tlv_port')
+DEFAULT_BRIDGE_CFG = BridgeCfg(gateway = '127.0.0.1', gateway_port = 31000, tlv_port = 31003)
+
+# ---------------------------------------------------------------------------
+#   Module Routines
+# ---------------------------------------------------------------------------
+
+_bridge_config_cache = {}                                   # Parsed bridge configuration files, by file name
+
+# Parse the bridge configuration file into a dictionary of sections, each holding a dictionary of
+# option values (first word only, to drop trailing comments). The file is only re-parsed when it has
+# been modified, so every IPSC system created from the same file shares one parse.
+def read_bridge_config(_config_file):
+    _mtime = os.stat(_config_file).st_mtime
+    _cached = _bridge_config_cache.get(_config_file)
+    if _cached and _cached[0] == _mtime:
+        return _cached[1]
+
+    config = ConfigParser.ConfigParser()
+    config.read(_config_file)
+
+    _sections = {}
+    for section in config.sections():
+        _sections[section] = {}
+        for opt, value in config.items(section):
+            if value.split(None):
+                _sections[section][opt] = value.split(None)[0]
+
+    _bridge_config_cache[_config_file] = (_mtime, _sections)
+    return _sections
+
+# Build the bridge settings for each named IPSC system from the bridge configuration file, parsing it
+# once for all of them. An option missing from a system's section falls back to BridgeGlobal, then the default.
+def load_bridge_config(_config_file, _names):
+    try:
+        _sections = read_bridge_config(_config_file)
+        _global = _sections['BridgeGlobal']
+
+        _bridge_cfgs = {}
+        for _name in _names:
+            _section = _sections.get(_global.get('section', str(_name)), _global)
+            _option = lambda _opt, _default: _section.get(_opt, _global.get(_opt, _default))
+
+            _bridge_cfgs[_name] = BridgeCfg(
+                gateway = _option('gateway', DEFAULT_BRIDGE_CFG.gateway),
+                gateway_port = int(_option('togatewayport', DEFAULT_BRIDGE_CFG.gateway_port)),
+                tlv_port = int(_option('fromgatewayport', DEFAULT_BRIDGE_CFG.tlv_port))
+            )
+    except:
+        import traceback                                    # only needed to report a bad configuration file
+        traceback.print_exc()
+        sys.exit('Configuration file \'' + _config_file + '\' is not a valid configuration file! Exiting...')
+
+    return _bridge_cfgs
+
+# Pull the IPSC sequence number (stream id), RTP sequence number and burst data type out of a
+# voice packet in one pass, rather than converting a separate slice for each
+def parse_voice_header(_data):
+    _header = bytearray(_data[0:31])
+    return _header[5], (_header[20] << 8) | _header[21], _header[30]
 
 # ---------------------------------------------------------------------------
 #   Class Declaration
@@ -63,22 +129,28 @@ from fne.fne_core import int_to_bytes, bytes_to_int, short_to_bytes
 # ---------------------------------------------------------------------------
 
 class bridgeIPSC(IPSC):
-    def __init__(self, _name, _config, _bridge_config, _logger, _report):
+    def __init__(self, _name, _config, _bridge_config, _logger, _report, _bridge_cfg = None):
         IPSC.__init__(self, _name, _config, _logger, _report)
 
         self._busy_slots = [0, 0, 0]                        # Keep track of activity on each slot.  Make sure app is polite
         self.cc = 1
 
-        self._tlvPort = 31003                               # Port to listen on for TLV frames to transmit to all peers
-        self._gateway = "127.0.0.1"                         # IP address of bridge app
-        self._gateway_port = 31000                          # Port bridge is listening on for TLV frames to decode
+        self._tlvPort = DEFAULT_BRIDGE_CFG.tlv_port         # Port to listen on for TLV frames to transmit to all peers
+        self._gateway = DEFAULT_BRIDGE_CFG.gateway          # IP address of bridge app
+        self._gateway_port = DEFAULT_BRIDGE_CFG.gateway_port # Port bridge is listening on for TLV frames to decode
         
         #
         # Define default values for operation.  These will be overridden by the .cfg file if found
         #
         
         self._currentNetwork = str(_name)
-        self.readConfigFile(_bridge_config, None, self._currentNetwork)
+        if _bridge_cfg is not None:
+            self._tlvPort = _bridge_cfg.tlv_port
+            self._gateway = _bridge_cfg.gateway
+            self._gateway_port = _bridge_cfg.gateway_port
+            logger.info('FromGatewayPort = %s, Gateway = %s, ToGatewayPort = %s', self._tlvPort, self._gateway, self._gateway_port)
+        else:
+            self.readConfigFile(_bridge_config, None, self._currentNetwork)
     
         logger.info('DMRLink IPSC Bridge')
 
@@ -89,24 +161,23 @@ class bridgeIPSC(IPSC):
 
     # Now read the configuration file and parse out the values we need
     def defaultOption(self, config, sec, opt, defaultValue):
-        try:
-            _value = config.get(sec, opt).split(None)[0]    # Get the value from the named section
-        except ConfigParser.NoOptionError as e:
-            try:
-                _value = config.get('BridgeGlobal', opt).split(None)[0] # Try the global BridgeGlobal section
-            except ConfigParser.NoOptionError as e:
-                _value = defaultValue                       # Not found anywhere, use the default value
+        if 'BridgeGlobal' not in config:
+            raise ConfigParser.NoSectionError('BridgeGlobal')
+
+        _opt = opt.lower()
+        _value = config.get(sec, {}).get(_opt)              # Get the value from the named section
+        if _value is None:
+            _value = config['BridgeGlobal'].get(_opt, defaultValue) # Try the global BridgeGlobal section, then the default value
         logger.info(opt + ' = ' + str(_value))
         return _value
 
     def readConfigFile(self, configFileName, sec, networkName='BridgeGlobal'):
-        config = ConfigParser.ConfigParser()
         try:
-            config.read(configFileName)
-            
+            config = read_bridge_config(configFileName)
+
             if sec == None:
                 sec = self.defaultOption(config, 'BridgeGlobal', 'section', networkName)
-            if config.has_section(sec) == False:
+            if sec not in config:
                 logger.info('Section ' + sec + ' was not found, using BridgeGlobal')
                 sec = 'BridgeGlobal'
 
@@ -114,41 +185,44 @@ class bridgeIPSC(IPSC):
             self._gateway = self.defaultOption(config, sec, 'Gateway', self._gateway)
             self._gateway_port = int(self.defaultOption(config, sec, 'ToGatewayPort', self._gateway_port))
 
-        except ConfigParser.NoOptionError as e:
-            print('Using a default value:', e)
         except:
+            import traceback
             traceback.print_exc()
             sys.exit('Configuration file \'' + configFileName + '\' is not a valid configuration file! Exiting...')
 
     def voice_call(self, _src_id, _dst_id, _group, _ts, _end, _peerId, _rtp, _data):
-        _tx_slot = self.tlv_ipsc.tx[_ts]
-        _payload_type = bytes_to_int(_data[30:31])
-        _seq = bytes_to_int(_data[20:22])
+        _tlv_ipsc = self.tlv_ipsc
+        _tx_slot = _tlv_ipsc.tx[_ts]
+        _stream_id, _seq, _payload_type = parse_voice_header(_data) # stream id is an int8, looks like a sequence number for a packet
         _tx_slot.frame_count += 1
 
-        if _payload_type == BURST_DATA_TYPE['VOICE_HEADER']:
-            _stream_id = bytes_to_int(_data[5:6])           # int8  looks like a sequence number for a packet
-            if (_stream_id != _tx_slot.stream_id):
-                self.tlv_ipsc.begin_call(_ts, _group, _src_id, _dst_id, _peerId, self.cc, _seq, _stream_id)
+        # voice bursts are by far the most common, so check for them first
+        if (_payload_type == _BDT_SLOT1_VOICE) or (_payload_type == _BDT_SLOT2_VOICE):
+            if len(_data) < VOICE_BURST_LEN:
+                self._logger.warning('(%s) Dropping short voice burst (%d bytes) on TS %d', self._system, len(_data), _ts)
+                return
+            _tlv_ipsc.export_voice(_tx_slot, _seq, ambe_utils.extract49BitAmbeFrames(_data[33:VOICE_BURST_LEN]))
+            return
+
+        _tx_stream_id = _tx_slot.stream_id
+        if _payload_type == _BDT_VOICE_HEADER:
+            if (_stream_id != _tx_stream_id):
+                _tlv_ipsc.begin_call(_ts, _group, _src_id, _dst_id, _peerId, self.cc, _seq, _stream_id)
             _tx_slot.lastSeq = _seq
 
-        if _payload_type == BURST_DATA_TYPE['PI_HEADER']:
-            _stream_id = bytes_to_int(_data[5:6])           # int8  looks like a sequence number for a packet
-            _alg_id = bytes_to_int(_data[38:39])
-            _key_id = bytes_to_int(_data[40:41])
-            _mi = _data[41:45]
-            if (_stream_id == _tx_slot.stream_id):
-                self.tlv_ipsc.pi_params(_ts, _dst_id, _alg_id, _key_id, _mi)
+        elif _payload_type == _BDT_PI_HEADER:
+            if len(_data) < PI_HEADER_LEN:
+                self._logger.warning('(%s) Dropping short PI header (%d bytes) on TS %d', self._system, len(_data), _ts)
+                return
+            _pi = bytearray(_data[38:41])
+            _alg_id = _pi[0]
+            _key_id = _pi[2]
+            _mi = _data[41:PI_HEADER_LEN]
+            if (_stream_id == _tx_stream_id):
+                _tlv_ipsc.pi_params(_ts, _dst_id, _alg_id, _key_id, _mi)
 
-        if _payload_type == BURST_DATA_TYPE['VOICE_TERMINATOR']:
-            self.tlv_ipsc.end_call(_tx_slot)
-
-        if (_payload_type == BURST_DATA_TYPE['SLOT1_VOICE']) or (_payload_type == BURST_DATA_TYPE['SLOT2_VOICE']):
-            _ambe_frames = BitArray('0x' + ahex(_data[33:52]))
-            _ambe_frame1 = _ambe_frames[0:49]
-            _ambe_frame2 = _ambe_frames[50:99]
-            _ambe_frame3 = _ambe_frames[100:149]
-            self.tlv_ipsc.export_voice(_tx_slot, _seq, _ambe_frame1.tobytes() + _ambe_frame2.tobytes() + _ambe_frame3.tobytes())
+        elif _payload_type == _BDT_VOICE_TERMINATOR:
+            _tlv_ipsc.end_call(_tx_slot)
 
     # ************************************************
     #  CALLBACK FUNCTIONS FOR USER PACKET TYPES
@@ -167,13 +241,13 @@ class bridgeIPSC(IPSC):
 
 if __name__ == '__main__':
     import argparse
-    import os
     import sys
     import signal
     from fne.fne_core import mk_id_dict
 
     from ipsc.dmrlink_log import config_logging    
     from ipsc.dmrlink_config import build_config
+    from ipsc.ipsc_udp import set_socket_buffers
     
     # Change the current directory to the location of the application
     os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
@@ -232,11 +306,15 @@ if __name__ == '__main__':
     # setup the reporting loop
     report_server = config_reports(config, logger, reportFactory)
 
+    # Read the bridge settings for every system up front
+    bridge_cfgs = load_bridge_config(cli_args.BridgeFile, config['Systems'].keys())
+
     # IPSC instance creation
     for system in config['Systems']:
         if config['Systems'][system]['LOCAL']['Enabled']:
-            systems[system] = bridgeIPSC(system, config, cli_args.BridgeFile, logger, report_server)
-            reactor.listenUDP(config['Systems'][system]['LOCAL']['PORT'], systems[system], interface = config['Systems'][system]['LOCAL']['IP'])
+            systems[system] = bridgeIPSC(system, config, cli_args.BridgeFile, logger, report_server, bridge_cfgs[system])
+            port = reactor.listenUDP(config['Systems'][system]['LOCAL']['PORT'], systems[system], interface = config['Systems'][system]['LOCAL']['IP'])
+            set_socket_buffers(port)
             logger.debug('Instance created: %s, %s', system, systems[system])
     
     reactor.run()
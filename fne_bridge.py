@@ -31,7 +31,6 @@ import struct
 import sys
 import socket
 import ConfigParser
-import thread
 import traceback
 
 from bitarray import bitarray
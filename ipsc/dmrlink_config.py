@@ -57,7 +57,8 @@ def build_config(_config_file):
                     'ReportRCM': config.get(section, 'ReportRCM'),
                     'ReportInterval': config.getint(section, 'ReportInterval'),
                     'ReportPort': config.get(section, 'ReportPort'),
-                    'ReportClients': config.get(section, 'ReportClients').split(',')
+                    'ReportClients': config.get(section, 'ReportClients').split(','),
+                    'ReportBatchSize': config.getint(section, 'ReportBatchSize') if config.has_option(section, 'ReportBatchSize') else 8192
                 })
                 if CONFIG['Reports']['ReportPort']:
                     CONFIG['Reports']['ReportPort'] = int(CONFIG['Reports']['ReportPort'])
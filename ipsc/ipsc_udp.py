@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Digital Voice Modem - Fixed Network Equipment
+# GPLv2 Open Source. Use is subject to license terms.
+# DO NOT ALTER OR REMOVE COPYRIGHT NOTICES OR THIS FILE HEADER.
+#
+# @package DVM / FNE / dmrlink
+#
+###############################################################################
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+###############################################################################
+
+# Full Imports
+import socket
+import sys
+
+# ---------------------------------------------------------------------------
+#   Constants
+# ---------------------------------------------------------------------------
+
+SOCKET_BUFFER_SIZE = 7 * 1024 * 1024                        # SO_SNDBUF/SO_RCVBUF size for IPSC sockets
+
+# Linux lets a privileged process go past net.core.rmem_max/wmem_max with these (not all Pythons define them)
+SO_SNDBUFFORCE = getattr(socket, 'SO_SNDBUFFORCE', 32)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+
+# ---------------------------------------------------------------------------
+#   Module Routines
+# ---------------------------------------------------------------------------
+
+# Enlarge the send and receive buffers of the socket behind a Twisted UDP port, so bursts of voice
+# traffic are not dropped by the kernel. Without CAP_NET_ADMIN the kernel caps the request at
+# net.core.wmem_max/rmem_max, e.g.: sysctl -w net.core.rmem_max=7340032 net.core.wmem_max=7340032
+def set_socket_buffers(_port, _size = SOCKET_BUFFER_SIZE):
+    _sock = _port.getHandle()
+    for _force_opt, _opt in [(SO_SNDBUFFORCE, socket.SO_SNDBUF), (SO_RCVBUFFORCE, socket.SO_RCVBUF)]:
+        if sys.platform.startswith('linux'):
+            try:
+                _sock.setsockopt(socket.SOL_SOCKET, _force_opt, _size)
+                continue
+            except socket.error:
+                pass                                        # not privileged, settle for the capped size
+        _sock.setsockopt(socket.SOL_SOCKET, _opt, _size)